@@ -3,18 +3,32 @@
 
 
 # Imports - builtin
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from itertools import chain
 from pathlib import Path
-from xml.etree import ElementTree
 import logging
+import os
+import shutil
 import subprocess
 
 
 # Imports - third-party
-import numpy as np
 import pandas
 
+# Prefer lxml's parser, falling back on the C accelerated standard library
+# implementation when lxml isn't installed.
+try:
+    from lxml import etree as ElementTree
+    HAS_LXML = True
+except ImportError:
+    HAS_LXML = False
+    try:
+        from xml.etree import cElementTree as ElementTree
+    except ImportError:
+        from xml.etree import ElementTree
+
 
 # Module metadata
 __author__ = 'Eric Horton, Kai Presler-Marshall'
@@ -26,21 +40,49 @@ ITRUST2 = PROJECT_ROOT / 'iTrust2'
 TIMEOUT = 60 * 40  # 40 minutes in seconds
 LOG = PROJECT_ROOT / 'log'
 STATS_FILE = LOG / 'build_stats.csv'
+RESULTS_FILE = LOG / 'test_results.csv'
 FAILING_TESTS_FILE = LOG / 'failing_tests.csv'
-FLAKY_TESTS_FILE = LOG / 'failing_tests.csv'
+FLAKY_TESTS_FILE = LOG / 'flaky_tests.csv'
 LOG_FORMAT = '%(asctime)-15s %(message)s'
+# Set QUIET=1 in the environment to discard test stdout/stderr logs
+QUIET = os.environ.get('QUIET', '0') == '1'
 EXECUTIONS = 30
-MVN = 'mvn'
+# Threads used to parse XML reports. Only lxml releases the GIL while
+# parsing, so reports are parsed serially without it.
+PARSE_THREADS = (os.cpu_count() or 1) if HAS_LXML else 1
+DB_NAME = 'iTrust2'
+SUREFIRE_REPORTS = 'target/surefire-reports'
+FAILSAFE_REPORTS = 'target/failsafe-reports'
+# Set to `mvnd` in the environment to reuse a warm Maven Daemon across builds
+MVN = os.environ.get('MVN', 'mvn')
+# Added to Maven commands of every execution after the first
+MVN_OFFLINE = ['--offline']
 DF_COLUMNS = ['execution', 'classname', 'name', 'time', 'failed']
+FAILING_COLUMNS = ['execution', 'classname', 'name', 'time']
+# Typed template for results frames, so empty frames keep native dtypes
+EMPTY_RESULTS = pandas.DataFrame(
+    {
+        'execution': pandas.Series(dtype='object'),
+        'classname': pandas.Series(dtype='object'),
+        'name': pandas.Series(dtype='object'),
+        'time': pandas.Series(dtype='float32'),
+        'failed': pandas.Series(dtype='bool')
+    },
+    columns=DF_COLUMNS
+)
+FLAKY_COLUMNS = ['classname', 'name', 'num_failing']
 BUILD_COLUMNS = ['id', 'time']
-TEST_CMD = [MVN + ' clean verify -DskipSurefireTests']
-DROP_DB_CMD = [
-    'mysql' + ' -u' + ' root' + ' -e' + " 'DROP DATABASE IF EXISTS iTrust2'"
+FAIL_TAGS = frozenset({'failure', 'error'})
+# Only the database and test reports are reset between executions. Compiled
+# classes are deterministic, so they are reused rather than cleaned.
+TEST_CMD = [
+    MVN, 'verify', '-DskipSurefireTests', '-Dmaven.test.failure.ignore=true'
 ]
-BUILD_DB_CMD = [
-    MVN + ' -f ' + str(ITRUST2) + '/pom-data.xml clean process-test-classes'
+DROP_DB_CMD = [
+    'mysql', '-u', 'root', '-e', 'DROP DATABASE IF EXISTS {db_name}'
 ]
-CLEAN_CMD = [MVN + ' clean']
+BUILD_DB_CMD = [MVN, '-f', '{artifact}/pom-data.xml', 'process-test-classes']
+CLEAN_CMD = [MVN, 'clean']
 
 
 # Configure logging
@@ -53,13 +95,50 @@ logger.addHandler(file_handler)
 logger.setLevel(logging.INFO)
 
 
-def run_tests(artifact):
+def run_executions(executions):
+    """Run executions of the artifact's tests, one after the other.
+
+    The first execution runs online, so Maven resolves every dependency and
+    plugin the others need to run offline.
+
+    Parameters
+    ----------
+    executions : int
+        Number of times to run the tests.
+
+    Yields
+    ------
+    tuple
+        Tuple of the test results and build stats of each execution.
+    """
+
+    if not executions:
+        return
+
+    # Run the first execution online
+    logger.info('Starting execution 1 of artifact {}.'.format(ITRUST2.stem))
+    yield run_tests(ITRUST2, offline=False)
+
+    # Run the rest offline
+    for i in range(1, executions):
+        logger.info('Starting execution {} of artifact {}.'.format(
+            i + 1,
+            ITRUST2.stem
+        ))
+        yield run_tests(ITRUST2)
+
+
+def run_tests(artifact, db_name=DB_NAME, offline=True):
     """Run an artifact's test cases.
 
     Parameters
     ----------
     artifact : Path
         Pathlib Path to the artifact directory.
+    db_name : string
+        Name of the database the artifact is configured to use.
+    offline : bool
+        Whether Maven should run offline, using only its local repository.
 
     Returns
     -------
@@ -67,33 +146,47 @@ def run_tests(artifact):
         Pandas DataFrame with the columns `classname, name, failed`.
     """
 
-    # Compute artifact stdout/stderr logfile names
+    # Compute artifact stdout/stderr logfile names. Output is discarded
+    # entirely when running quietly.
     build_id = datetime.now().isoformat().replace(':', '_')
-    stdout_log = LOG / '{}.{}.stdout.log'.format(artifact.stem, build_id)
-    stderr_log = LOG / '{}.{}.stderr.log'.format(artifact.stem, build_id)
+    if QUIET:
+        stdout_log = stderr_log = os.devnull
+    else:
+        stdout_log = LOG / '{}.{}.stdout.log'.format(artifact.stem, build_id)
+        stderr_log = LOG / '{}.{}.stderr.log'.format(artifact.stem, build_id)
+
+    # Only use Maven's local repository when running offline
+    mvn_args = MVN_OFFLINE if offline else []
+    build_db_cmd = [cmd.format(artifact=artifact) for cmd in BUILD_DB_CMD]
+    build_db_cmd += mvn_args
+    test_cmd = TEST_CMD + mvn_args
 
     # Begin context with log files
     with open(stdout_log, 'wb+') as stdout, open(stderr_log, 'wb+') as stderr:
 
         # Drop database
-        logger.info('Dropping database with `{}`'.format(DROP_DB_CMD))
-        subprocess.run(DROP_DB_CMD, shell=True)
+        drop_db_cmd = [cmd.format(db_name=db_name) for cmd in DROP_DB_CMD]
+        logger.info('Dropping database with `{}`'.format(drop_db_cmd))
+        subprocess.run(drop_db_cmd)
+
+        logger.info('Rebuilding database with `{}`'.format(build_db_cmd))
+        subprocess.run(build_db_cmd)
 
-        logger.info('Rebuilding database with `{}`'.format(BUILD_DB_CMD))
-        subprocess.run(BUILD_DB_CMD, shell=True)
+        # Remove reports left over from previous executions
+        for reports_dir in (SUREFIRE_REPORTS, FAILSAFE_REPORTS):
+            shutil.rmtree(artifact / reports_dir, ignore_errors=True)
 
         # Spawn test process. Pipe stdout and stderr to file.
-        logger.info('Running `{}` for artifact {}'.format(TEST_CMD, artifact))
+        logger.info('Running `{}` for artifact {}'.format(test_cmd, artifact))
         logger.info('Stdout logged to {}'.format(stdout_log))
         logger.info('Stderr logged to {}'.format(stderr_log))
 
         start_time = datetime.now()
         proc = subprocess.Popen(
-            args=TEST_CMD,
+            args=test_cmd,
             cwd=artifact,
             stdout=stdout,
-            stderr=stderr,
-            shell=True
+            stderr=stderr
         )
 
         # Wait for process to finish. If a timeout occurs, terminate
@@ -117,8 +210,14 @@ def run_tests(artifact):
             proc.returncode
         ))
 
-        # Scrape test results
+        # Scrape test results. A failed build with no results most likely
+        # never ran the tests, so it mustn't pass for a clean execution.
         test_results = scrape_results(artifact, build_id)
+        if proc.returncode != 0 and not len(test_results):
+            logger.warning(
+                'Tests exited with status {} and no test reports were '
+                'found.'.format(proc.returncode)
+            )
 
         # Compute build stats
         build_time = end_time - start_time
@@ -147,106 +246,218 @@ def scrape_results(artifact, execution):
     """
 
     # Compute surefire directory
-    surefire_dir = artifact / 'target/surefire-reports'
+    surefire_dir = artifact / SUREFIRE_REPORTS
     logger.info('Looking for XML reports in {}'.format(surefire_dir))
 
     # Compute failsafe directory
-    failsafe_dir = artifact / 'target/failsafe-reports'
+    failsafe_dir = artifact / FAILSAFE_REPORTS
     logger.info('Looking for XML reports in {}'.format(failsafe_dir))
 
-    # Load all test XML report files using file globs
-    reports = list(chain(*(
-        list(reports_dir.glob('TEST*.xml'))
-        for reports_dir in (surefire_dir, failsafe_dir)
-    )))
+    # Find every XML report in either directory
+    reports = list(chain(
+        iter_reports(surefire_dir),
+        iter_reports(failsafe_dir)
+    ))
     logger.info('Found {} total reports'.format(len(reports)))
 
-    # Map each report to a result set
-    results = list(map(
-        lambda report: ElementTree.parse(report).getroot()[1:],
-        reports
-    ))
+    # Collect each column of the results separately
+    classnames, names, times, failed = [], [], [], []
+    for testcases in parse_reports(reports):
+        for classname, name, time, failure in testcases:
+            classnames.append(classname)
+            names.append(name)
+            times.append(time)
+            failed.append(failure)
 
     # Parse results as a pandas dataframe
-    # Failure is a boolean, determined by if the testcase has a child whose
-    # tag is `failure` or `error`.
-    if len(results):
-        df = pandas.DataFrame(
-            np.array([
-                [
-                    execution,
-                    testcase.attrib['classname'],
-                    testcase.attrib['name'],
-                    testcase.attrib['time'],
-                    np.any(list(map(
-                        lambda e: e.tag == 'failure' or e.tag == 'error',
-                        testcase
-                    )))
-                ]
-                for result_set in results
-                for testcase in result_set
-            ]),
-            columns=DF_COLUMNS
-        )
-    else:
-        df = pandas.DataFrame(columns=DF_COLUMNS)
+    df = pandas.DataFrame(
+        {
+            'execution': [execution] * len(classnames),
+            'classname': classnames,
+            'name': names,
+            'time': pandas.Series(times, dtype='float32'),
+            'failed': pandas.Series(failed, dtype='bool')
+        },
+        columns=DF_COLUMNS
+    )
 
     # Log and return
     logger.info('Found {} total test cases'.format(len(df)))
     return df
 
 
+def parse_reports(reports):
+    """Parse the test cases out of XML reports, on PARSE_THREADS threads.
+
+    Parameters
+    ----------
+    reports : list
+        Paths to surefire/failsafe XML reports.
+
+    Yields
+    ------
+    iterable
+        Test case tuples of each report, as from `iterparse_testcases`, in
+        the order of `reports`.
+    """
+
+    if PARSE_THREADS == 1:
+        yield from map(iterparse_testcases, reports)
+        return
+
+    with ThreadPoolExecutor(max_workers=PARSE_THREADS) as executor:
+        yield from executor.map(
+            lambda report: list(iterparse_testcases(report)),
+            reports
+        )
+
+
+def iter_reports(reports_dir):
+    """Find the XML reports in a flat surefire/failsafe reports directory.
+
+    Parameters
+    ----------
+    reports_dir : Path
+        Pathlib Path to the reports directory. It need not exist.
+
+    Yields
+    ------
+    string
+        Path to each `TEST*.xml` report.
+    """
+
+    # Reports directories are missing if their plugin was skipped
+    if not reports_dir.is_dir():
+        return
+
+    with os.scandir(reports_dir) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.startswith('TEST') and name.endswith('.xml'):
+                yield entry.path
+
+
+def iterparse_testcases(report):
+    """Stream the test cases out of a single XML report.
+
+    Elements are cleared as soon as they have been read, so memory use stays
+    constant regardless of the size of the report.
+
+    Parameters
+    ----------
+    report : string
+        Path to a surefire/failsafe XML report.
+
+    Yields
+    ------
+    tuple
+        Tuple of `classname, name, time, failed`. Time is in seconds, as a
+        float. Failure is a boolean, determined by if the testcase has a child
+        whose tag is `failure` or `error`.
+    """
+
+    # Hold on to the root so processed elements can be released from it.
+    # Only the API shared by lxml and the standard library is used here.
+    events = ElementTree.iterparse(str(report), events=('start', 'end'))
+    _, root = next(events)
+
+    for event, testcase in events:
+        if event == 'end' and testcase.tag == 'testcase':
+            attrib = testcase.attrib
+            yield (
+                attrib['classname'],
+                attrib['name'],
+                # Surefire may group thousands in long running times
+                float(attrib['time'].replace(',', '')),
+                any(c.tag in FAIL_TAGS for c in testcase)
+            )
+
+            # Free the testcase and any siblings already processed
+            root.clear()
+
+
 def main():
     """Main function. Run experiment and collect data."""
 
     # Start
     logger.info('Starting new set of flakiness tests.')
 
-    # Start empty results frames
-    results = pandas.DataFrame([], columns=DF_COLUMNS)
-    build_stats = pandas.DataFrame([], columns=BUILD_COLUMNS)
+    # Start result files. Results are appended as each execution finishes.
+    EMPTY_RESULTS.to_csv(RESULTS_FILE, index=False)
+    pandas.DataFrame(columns=BUILD_COLUMNS).to_csv(STATS_FILE, index=False)
+    EMPTY_RESULTS[FAILING_COLUMNS].to_csv(FAILING_TESTS_FILE, index=False)
+    pandas.DataFrame(columns=FLAKY_COLUMNS).to_csv(
+        FLAKY_TESTS_FILE,
+        index=False
+    )
+
+    # Only keep the small per-execution frames in memory, and tally how many
+    # times each test ran and failed
+    stats_list = []
+    failing_list = []
+    total = Counter()
+    fails = Counter()
 
     # Clean before running tests
     logger.info('Cleaning build with `{}`'.format(CLEAN_CMD))
-    subprocess.run(CLEAN_CMD, cwd=ITRUST2, shell=True)
+    subprocess.run(CLEAN_CMD, cwd=ITRUST2)
 
-    # Run tests
-    for i in range(EXECUTIONS):
+    # Run tests, writing results as executions finish
+    for execution_results, execution_stats in run_executions(EXECUTIONS):
 
-        logger.info('Starting execution {} of artifact {}.'.format(
-            i + 1,
-            ITRUST2.stem
-        ))
-        execution_results, execution_stats = run_tests(ITRUST2)
-        results = pandas.concat([results, execution_results])
-        build_stats = pandas.concat([build_stats, execution_stats])
-
-    # Get all failing test cases
-    failing = results[results['failed'].astype('str') == 'True'][[
-        'execution', 'classname', 'name', 'time'
-    ]]
-
-    # Determine which tests are flaky, and how many executions failed
-    def is_flaky(s):
-        return (
-            (s.astype('str') == 'True').any()
-            and not (s.astype('str') == 'True').all()
-        )
+        execution_failing = execution_results[
+            execution_results['failed']
+        ][FAILING_COLUMNS]
 
-    def num_failing(s):
-        return len(s[s.astype('str') == 'True'])
+        execution_results.to_csv(
+            RESULTS_FILE,
+            mode='a',
+            header=False,
+            index=False
+        )
+        execution_stats.to_csv(
+            STATS_FILE,
+            mode='a',
+            header=False,
+            index=False
+        )
+        execution_failing.to_csv(
+            FAILING_TESTS_FILE,
+            mode='a',
+            header=False,
+            index=False
+        )
 
-    flaky = (
-        results.drop(columns=['execution'])
-        .groupby(['classname', 'name'], as_index=False)['failed']
-        .agg([is_flaky, num_failing]).reset_index()
+        stats_list.append(execution_stats)
+        failing_list.append(execution_failing)
+
+        for test, failed in zip(
+            zip(execution_results['classname'], execution_results['name']),
+            execution_results['failed']
+        ):
+            total[test] += 1
+            if failed:
+                fails[test] += 1
+
+    # Combine the small frames from all executions at once
+    if stats_list:
+        build_stats = pandas.concat(stats_list, ignore_index=True)
+        failing = pandas.concat(failing_list, ignore_index=True)
+    else:
+        build_stats = pandas.DataFrame(columns=BUILD_COLUMNS)
+        failing = EMPTY_RESULTS[FAILING_COLUMNS].copy()
+
+    # Tests are flaky if they failed in some, but not all, executions. Only
+    # tests which failed at least once are counted in `fails`.
+    flaky = pandas.DataFrame(
+        sorted(
+            (classname, name, failures)
+            for (classname, name), failures in fails.items()
+            if failures < total[(classname, name)]
+        ),
+        columns=FLAKY_COLUMNS
     )
 
-    # Subset to only the flaky tests
-    flaky = flaky[flaky['is_flaky'].astype('str') == 'True'][[
-        'classname', 'name', 'num_failing'
-    ]]
-
     # With print context
     context = pandas.option_context(
         'display.max_rows', None,
@@ -259,7 +470,6 @@ def main():
 
         # Log build stats
         logger.info('Build Stats:\n' + str(build_stats) + '\n')
-        build_stats.to_csv(STATS_FILE, index=False)
 
         logger.info('Average Build Time: {}'.format(
             build_stats['time'].mean()
@@ -271,14 +481,14 @@ def main():
         # Log failing test cases, if any
         if len(failing):
             logger.info('Failing Test Cases:\n' + str(failing) + '\n')
-            failing.to_csv(FAILING_TESTS_FILE, index=False)
         else:
             logger.info('No failing test cases.')
 
-        # Log flaky test cases, if any
+        # Log flaky test cases, if any. The file is always written so it
+        # never holds a previous run's results.
+        flaky.to_csv(FLAKY_TESTS_FILE, index=False)
         if len(flaky):
             logger.info('Flaky Test Cases:\n' + str(flaky) + '\n')
-            flaky.to_csv(FLAKY_TESTS_FILE, index=False)
         else:
             logger.info('No flaky test cases.')
 